@@ -1,8 +1,25 @@
-import collections
+import collections.abc
+import json
+import os
 import pickle
+import shutil
+import sys
+import tempfile
+from functools import lru_cache
 from typing import Union
 
 
+@lru_cache(maxsize=4096)
+def _split_label(label: str):
+    """ Splits a dot label into its levels, cached for repeated labels.
+
+    Levels are interned so lookups with them can match dict keys by identity.
+    :param label: Dot String label
+    :return: tuple of levels
+    """
+    return tuple(sys.intern(level) for level in label.split('.'))
+
+
 def set_dict_at(d: dict, label: str, val):
     """ Sets a nested dict value using dot label.
 
@@ -13,14 +30,19 @@ def set_dict_at(d: dict, label: str, val):
     :param val: Value to place
     :return: None
     """
-    levels = label.split('.')
-    if len(levels) == 1:
-        d[levels[0]] = val
+    if '.' not in label:
+        d[label] = val
         return
     else:
+        levels = _split_label(label)
         cur = d
         for level in levels[:-1]:
-            cur = cur.setdefault(level, {})
+            # Only build the new level on a miss, unlike setdefault's eager default
+            try:
+                cur = cur[level]
+            except KeyError:
+                cur[level] = {}
+                cur = cur[level]
         cur[levels[-1]] = val
 
 
@@ -32,14 +54,13 @@ def get_dict_at(d: dict, label: str):
     :param label: Dot String label
     :return: None
     """
-    levels = label.split('.')
-    if len(levels) == 1:
-        return d[levels[0]]
+    if '.' not in label:
+        return d[label]
     else:
         cur = d
-        for level in levels[:-1]:
+        for level in _split_label(label):
             cur = cur[level]
-        return cur[levels[-1]]
+        return cur
 
 
 def is_in_dict(d: dict, label: str):
@@ -50,7 +71,12 @@ def is_in_dict(d: dict, label: str):
     :return: True/False is in dict
     """
     try:
-        val = get_dict_at(d, label)
+        if '.' not in label:
+            val = d[label]
+        else:
+            val = d
+            for level in _split_label(label):
+                val = val[level]
         if val is None or val == '':
             return False
     except KeyError:
@@ -67,6 +93,11 @@ def update_nested_dict(original: dict, update: Union[dict, collections.abc.Mappi
     :param update: Updates for Dictionary, as a Dictionary (can be sparse)
     :return: Updated Dictionary
     """
+    # A flat update into a mapping has nothing to recurse into, so let dict.update() merge it in one go
+    if isinstance(original, collections.abc.MutableMapping) and \
+            not any(isinstance(v, collections.abc.Mapping) for v in update.values()):
+        original.update(update)
+        return original
     # Iterate over each current-level item
     for k, v in update.items():
         # If the value is a Mapping, it's a next level which should be handled recursively
@@ -87,32 +118,66 @@ def flatten(d, parent_key='', sep='.'):
     :param sep: delimiter for nested keys
     :return: dict flattened dict
     """
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
+    out = {}
+    put = out.__setitem__
+    # Stack of (key prefix, item iterator) so nested keys keep their original order
+    stack = [(parent_key, iter(d.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            new_key = prefix + sep + k if prefix else k
+            if isinstance(v, collections.abc.MutableMapping):
+                stack.append((new_key, iter(v.items())))
+                break
+            put(new_key, v)
         else:
-            items.append((new_key, v))
-    return dict(items)
+            stack.pop()
+    return out
 
 
-def to_file(data: dict, path: str):
-    """ Writes a dict to a file using pickle.
+def to_file(data: dict, path: str, legacy: bool = False):
+    """ Writes a dict to a file as JSON.
 
-    This function wraps pickle so that functionality can be replaced with an alternative easily.
+    This function wraps the serializer so that functionality can be replaced with an alternative easily.
+    Leaves of the dict should be JSON primitives; use legacy=True to write arbitrary objects with pickle.
+    The dict is written and fsynced to a unique temporary file next to path, which then replaces path,
+    so an interrupted or concurrent write leaves a complete file. Symlinks are followed and an existing
+    file's mode is kept; a new file is created accessible only by its owner.
     :param data: Python Dict
     :param path: Path to write the file
+    :param legacy: Write with pickle instead of JSON
     :return: None
     """
-    pickle.dump(data, open(path, "wb"))
-
-
-def from_file(path: str):
-    """ Reads a dict from a file using pickle.
-
-    This function wraps pickle so that functionality can be replaced with an alternative easily.
+    path = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, "wb" if legacy else "w", buffering=1 << 20) as f:
+            if legacy:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Don't leave a partial temporary file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def from_file(path: str, legacy: bool = False):
+    """ Reads a dict from a JSON file.
+
+    This function wraps the serializer so that functionality can be replaced with an alternative easily.
     :param path: Path to read file from
+    :param legacy: Read a pickle file written with to_file(..., legacy=True)
     :return: Python Dict
     """
-    return pickle.load(open(path, "rb"))
+    if legacy:
+        with open(path, "rb", buffering=1 << 20) as f:
+            return pickle.load(f)
+    with open(path, "r") as f:
+        return json.loads(f.read())
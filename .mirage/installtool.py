@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
+import concurrent.futures
 import datetime
 import getpass
 import hashlib
+import os
 import pathlib
+import re
+import select
+import shlex
+import sqlite3
+import threading
 import traceback
 
-import paramiko
-from scp import SCPClient
-
 __author__ = "Jordan Blackadar <blackadar@photodiagnostic.com>"
 
 BCC_IP = '192.168.6.6'
 DCC_IP = '192.168.5.5'
 RCC_IP = 'localhost'
 
+MD5_CHUNK_SIZE = 1 << 20
+MD5_CACHE_NAME = '.mirage_md5.db'  # Kept in the user's home directory
+
+# Bytes SCPClient reads and sends per chan.sendall during uploads (scp's default is 16 KiB)
+SCP_BUFF_SIZE = 1 << 20
+SSH_RECV_SIZE = 1 << 16
+SSH_POLL_TIMEOUT = 1.0
+
+# md5tool.sh wraps each md5sum output line in '|' markers: |<md5>  <file>|
+MD5_LINE_RE = re.compile(r'^\|([0-9a-f]{32}) [ *](.+)\|\s*$', re.MULTILINE)
+
 BCC_PACK_LIST = [
         'ckct-BaseCC',
         'ckct-bcc_config',
@@ -40,6 +56,12 @@ RCC_PACK_LIST = [
         'ckct-utils49172',
 ]
 
+# Sorted (prefix, computer) pairs for classifying RPM names by bisection
+_PACK_PREFIXES = sorted([(p, 'RCC') for p in RCC_PACK_LIST] +
+                        [(p, 'DCC') for p in DCC_PACK_LIST] +
+                        [(p, 'BCC') for p in BCC_PACK_LIST])
+_PACK_PREFIX_KEYS = [p for p, _ in _PACK_PREFIXES]
+
 
 def splash():
     """
@@ -66,7 +88,8 @@ def menu(options: list, title: str = ''):
     :param title: Title of the Menu
     :return: Index of String Selected by User
     """
-    assert len(options) > 0, "Zero option menu was requested, which would soft-lock the user."
+    if len(options) < 1:
+        raise ValueError("Zero option menu was requested, which would soft-lock the user.")
     print(f"<< {title if title else 'Selection'} >>")
     print("-" * 32)
     for idx, option in enumerate(options):
@@ -78,9 +101,10 @@ def menu(options: list, title: str = ''):
         inp = input("> ")
         try:
             selection = int(inp) - 1
-            assert selection in range(0, len(options))
+            if not 0 <= selection < len(options):
+                raise ValueError(f"{selection} is out of range")
             return selection
-        except (ValueError, TypeError, AssertionError):
+        except (ValueError, TypeError):
             print(f"'{inp}' is not an option. Try again.")
             selection = None
 
@@ -94,7 +118,8 @@ def multi_menu(options: list, title: str = ''):
     :param title: Title of the Menu
     :return: List of String Indexes Selected by the User
     """
-    assert len(options) > 0, "Zero option multi-menu was requested, which would soft-lock the user."
+    if len(options) < 1:
+        raise ValueError("Zero option multi-menu was requested, which would soft-lock the user.")
     print(f"<< {title if title else 'Multi-Selection'} >>")
     print("-" * 32)
     for idx, option in enumerate(options):
@@ -112,9 +137,10 @@ def multi_menu(options: list, title: str = ''):
             inp = inp.strip()
             try:
                 selection = int(inp) - 1
-                assert selection in range(0, len(options) + 1)
+                if not 0 <= selection < len(options) + 1:
+                    raise ValueError(f"{selection} is out of range")
                 indexes.append(selection)
-            except (ValueError, TypeError, AssertionError):
+            except (ValueError, TypeError):
                 print(f"'{inp}' is not an option. Try again.")
                 done = False
                 indexes = []
@@ -164,11 +190,27 @@ def find_rpms(recursive=False, path='.', title_match=''):
     :return: list of Paths
     """
     path = pathlib.Path(path).resolve()
-    assert path.exists(), f"Supplied path {path} does not exist!"
-    if recursive:
-        return sorted(path.rglob(f"{('*' + title_match) if title_match else ''}*.rpm"))
-    else:
-        return sorted(path.glob(f"{('*' + title_match) if title_match else ''}*.rpm"))
+    if not path.exists():
+        raise FileNotFoundError(f"Supplied path {path} does not exist!")
+    found = []
+
+    def scan(directory):
+        # DirEntry caches its type, so no Path objects or extra stats for entries we don't keep
+        try:
+            entries = os.scandir(directory)
+        except PermissionError:
+            return  # Unreadable directories are skipped, as glob/rglob did
+        with entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith('.rpm') and title_match in name[:-4] and entry.is_file():
+                    found.append(pathlib.Path(entry.path))
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    scan(entry.path)
+
+    scan(os.fspath(path))
+    found.sort()
+    return found
 
 
 def verbose_rpm_ask(target: str, arch: str):
@@ -204,20 +246,86 @@ def verbose_rpm_ask(target: str, arch: str):
     return [rpms[i] for i in to_install]
 
 
+_md5_cache = None
+_md5_cache_lock = threading.Lock()
+
+
+def md5_cache():
+    """
+    Opens the md5 cache database on first use.
+    The connection is shared by hashing threads, so all access must hold _md5_cache_lock.
+    :return: sqlite3.Connection
+    """
+    global _md5_cache
+    if _md5_cache is None:
+        try:
+            path = pathlib.Path.home() / MD5_CACHE_NAME
+        except (RuntimeError, KeyError) as e:
+            raise sqlite3.OperationalError(f"No home directory for the md5 cache: {e}") from e
+        _md5_cache = sqlite3.connect(path, check_same_thread=False)
+        # md5s was the older table keyed only on (path, mtime, size), which copies can fake
+        _md5_cache.execute("DROP TABLE IF EXISTS md5s")
+        _md5_cache.execute("CREATE TABLE IF NOT EXISTS file_md5s "
+                           "(path TEXT PRIMARY KEY, mtime INTEGER, ctime INTEGER, size INTEGER, inode INTEGER, "
+                           "md5 TEXT)")
+    return _md5_cache
+
+
 def calc_md5(path):
     """
     Find the md5sum of the file at the specified path.
-    Loads file in 2^13 byte chunks to avoid high memory usage.
-    https://stackoverflow.com/questions/16874598/how-do-i-calculate-the-md5-checksum-of-a-file-in-python
+    See lookup_md5 for how results are cached.
     :param path: path to File
     :return: md5sum as a string
     """
-    path = pathlib.Path(path).resolve()
-    assert path.exists(), f"md5sum requested for nonexistent path {path}!"
+    return lookup_md5(path)[0]
+
 
+def lookup_md5(path):
+    """
+    Find the md5sum of the file at the specified path, reporting whether it came from the cache.
+    Results are cached in MD5_CACHE_NAME under the home directory by (path, mtime, ctime, size, inode),
+    so unchanged files are not re-read. ctime and inode are included because copy tools can preserve
+    mtime and size while replacing contents, but any write, rename or utime updates ctime.
+    If the cache can't be used, the file is simply hashed.
+    :param path: path to File
+    :return: tuple (md5sum as a string, bool came from cache)
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+    try:
+        with _md5_cache_lock:
+            row = md5_cache().execute("SELECT md5 FROM file_md5s "
+                                      "WHERE path=? AND mtime=? AND ctime=? AND size=? AND inode=?", key).fetchone()
+        if row:
+            return row[0], True
+    except sqlite3.Error:
+        return hash_file(path), False
+
+    md5 = hash_file(path)
+    try:
+        with _md5_cache_lock, md5_cache() as db:
+            db.execute("INSERT OR REPLACE INTO file_md5s VALUES (?, ?, ?, ?, ?, ?)", key + (md5,))
+    except sqlite3.Error:
+        pass  # A cache miss next time is harmless
+    return md5, False
+
+
+def hash_file(path):
+    """
+    Find the md5sum of the file at the specified path, without the cache.
+    Hashing is done by hashlib.file_digest, which reads in large blocks outside the GIL.
+    Before Python 3.11, falls back to reading the file in 2^20 byte chunks.
+    md5 is only an integrity check here, so it's requested with usedforsecurity=False to work on FIPS systems.
+    :param path: path to File
+    :return: md5sum as a string
+    """
     with open(path, "rb") as f:
-        file_hash = hashlib.md5()
-        while chunk := f.read(8192):
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, lambda: hashlib.new("md5", usedforsecurity=False)).hexdigest()
+        file_hash = hashlib.new("md5", usedforsecurity=False)
+        while chunk := f.read(MD5_CHUNK_SIZE):
             file_hash.update(chunk)
 
     return file_hash.hexdigest()
@@ -230,19 +338,13 @@ def read_md5_file(path):
     :return: dict file:md5sum
     """
     path = pathlib.Path(path).resolve()
-    assert path.exists(), f"md5sum read requested for nonexistent path {path}!"
+    if not path.exists():
+        raise FileNotFoundError(f"md5sum read requested for nonexistent path {path}!")
 
     with open(path, "r") as f:
-        lines = f.readlines()
+        text = f.read()
 
-    hashes = {}
-    for line in lines:
-        if line[0] != '|' or line[-2] != '|':  # Special markers for md5tool files
-            continue  # Skip this line
-        row = line.replace('|', '').strip().split(' ')
-        hashes[row[2]] = row[0]
-
-    return hashes
+    return {m.group(2): m.group(1) for m in MD5_LINE_RE.finditer(text)}
 
 
 def verify_md5s(rpms: list, md5_file):
@@ -255,24 +357,38 @@ def verify_md5s(rpms: list, md5_file):
     """
     try:
         hashes = read_md5_file(md5_file)
-    except AssertionError as e:
+    except FileNotFoundError:
         print(f"I couldn't find the file {md5_file} on disk. Please download that file and try again!")
         return False
     print(f"Ok! I found {len(hashes)} md5sums in the build output. Let's see if they match.")
     passed = True
 
-    for rpm in rpms:
-        rpm = rpm.name
-        if rpm not in hashes.keys():
-            print(f"- [X] {rpm} was not in md5.txt. I can't verify that hash.")
+    rpm_paths = {rpm.name: rpm for rpm in rpms}
+    for name in sorted(rpm_paths.keys() - hashes.keys()):
+        print(f"- [X] {name} was not in md5.txt. I can't verify that hash.")
+        passed = False
+
+    to_hash = []
+    for name in sorted(rpm_paths.keys() & hashes.keys()):
+        if not os.path.exists(rpm_paths[name]):
+            print(f"- [X] {name} is missing from disk. I can't verify that hash.")
             passed = False
             continue
-        md5 = calc_md5(rpm)
-        if md5 != hashes[rpm]:
-            print(f"- [X] {rpm} failed the check! Expected {hashes[rpm]} but I found the hash to be {md5}.")
-            passed = False
-        else:
-            print(f"- {rpm} matches my hash calculation.")
+        to_hash.append(name)
+
+    if not to_hash:
+        return passed
+
+    # Hash concurrently; file_digest releases the GIL so the reads overlap
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(to_hash))) as pool:
+        results = pool.map(lookup_md5, [rpm_paths[name] for name in to_hash])
+        for rpm, (md5, cached) in zip(to_hash, results):
+            source = "the hash I saved for this unchanged file" if cached else "my hash calculation"
+            if md5 != hashes[rpm]:
+                print(f"- [X] {rpm} failed the check! Expected {hashes[rpm]} but {source} is {md5}.")
+                passed = False
+            else:
+                print(f"- {rpm} matches {source}.")
 
     return passed
 
@@ -287,24 +403,26 @@ def pack_list(found_rpms: list):
     rcc_pack_list = []
     dcc_pack_list = []
     bcc_pack_list = []
+    pack_lists = {'RCC': rcc_pack_list, 'DCC': dcc_pack_list, 'BCC': bcc_pack_list}
 
     all_ok = True
 
-    def find_partial(full, partial_list):
-        result = list(filter(lambda x: full.startswith(x), partial_list))
-        return len(result) > 0
+    def find_computer(full):
+        # Any prefix of full sorts between itself and full, so search down from the nearest key
+        idx = bisect.bisect_right(_PACK_PREFIX_KEYS, full) - 1
+        while idx >= 0:
+            key = _PACK_PREFIX_KEYS[idx]
+            if full.startswith(key):
+                return _PACK_PREFIXES[idx][1]
+            idx = bisect.bisect_right(_PACK_PREFIX_KEYS, os.path.commonprefix((full, key))) - 1
+        return None
 
     for rpm in found_rpms:
         name = rpm.name
-        if find_partial(name, RCC_PACK_LIST):
-            print(f"{name} is assigned to RCC.")
-            rcc_pack_list.append(rpm)
-        elif find_partial(name, DCC_PACK_LIST):
-            print(f"{name} is assigned to DCC.")
-            dcc_pack_list.append(rpm)
-        elif find_partial(name, BCC_PACK_LIST):
-            print(f"{name} is assigned to BCC.")
-            bcc_pack_list.append(rpm)
+        computer = find_computer(name)
+        if computer is not None:
+            print(f"{name} is assigned to {computer}.")
+            pack_lists[computer].append(rpm)
         else:
             all_ok = False
             print(f"I'm not sure where {name} should go. We can proceed if this package should be ignored.")
@@ -352,13 +470,54 @@ def remote_connect(remote_ip, remote_username, remote_password):
     :param remote_password: Password of the remote.
     :return: tuple (client, scpclient)
       """
+    # Imported here so the md5 and menu helpers don't pay for loading paramiko's crypto backends
+    import paramiko
+    from scp import SCPClient
+
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client.connect(hostname=remote_ip, username=remote_username, password=remote_password, timeout=10)
-    scp = SCPClient(client.get_transport())
+    scp = SCPClient(client.get_transport(), buff_size=SCP_BUFF_SIZE)
     return client, scp
 
 
+def remote_exec(ssh, command, stdin_data=None):
+    """
+    Executes a command on a new session channel of the established SSH transport.
+    An SSH channel carries a single exec, so it's the transport (and its authentication) that is reused.
+    No PTY is requested for the channel. Output is drained while the command runs,
+    so a chatty command can't fill the remote pipe and stall before exiting.
+    :param ssh: Remote connection object from remote_connect
+    :param command: Command to execute.
+    :param stdin_data: Optional string to send to the command's stdin
+    :return: tuple (exitcode, stdout lines, stderr lines)
+    """
+    channel = ssh.get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        if stdin_data is not None:
+            channel.sendall(stdin_data.encode())
+        out = bytearray()
+        err = bytearray()
+        while not channel.exit_status_ready():
+            select.select([channel], [], [], SSH_POLL_TIMEOUT)
+            while channel.recv_ready():
+                out += channel.recv(SSH_RECV_SIZE)
+            while channel.recv_stderr_ready():
+                err += channel.recv_stderr(SSH_RECV_SIZE)
+        # Anything still in flight arrives before EOF, where recv returns b''
+        while chunk := channel.recv(SSH_RECV_SIZE):
+            out += chunk
+        while chunk := channel.recv_stderr(SSH_RECV_SIZE):
+            err += chunk
+        exitcode = channel.recv_exit_status()
+        return (exitcode,
+                out.decode("utf-8", "replace").splitlines(keepends=True),
+                err.decode("utf-8", "replace").splitlines(keepends=True))
+    finally:
+        channel.close()
+
+
 def remote_privileged_command(ssh, command, remote_password):
     """
     Executes a command with sudo over established SSH connection.
@@ -370,14 +529,10 @@ def remote_privileged_command(ssh, command, remote_password):
     command = "sudo -S -p '' %s" % command
     print(f"Running SSH command '{command}'.")
 
-    stdin, stdout, stderr = ssh.exec_command(command=command)
-    stdin.write(remote_password + "\n")
-    stdin.flush()
-
-    exitcode = stdout.channel.recv_exit_status()
+    exitcode, out, err = remote_exec(ssh, command, stdin_data=remote_password + "\n")
 
-    print(f"  - Output: {stdout.readlines()}")
-    print(f"  - Error Stream: {stderr.readlines()}")
+    print(f"  - Output: {out}")
+    print(f"  - Error Stream: {err}")
     print(f"  - Exit Code: {exitcode}")
 
     return exitcode == 0
@@ -392,12 +547,10 @@ def remote_command(ssh, command):
     """
     print(f"Running SSH command '{command}'.")
 
-    stdin, stdout, stderr = ssh.exec_command(command=command)
+    exitcode, out, err = remote_exec(ssh, command)
 
-    exitcode = stdout.channel.recv_exit_status()
-
-    print(f"  - Output: {stdout.readlines()}")
-    print(f"  - Error Stream: {stderr.readlines()}")
+    print(f"  - Output: {out}")
+    print(f"  - Error Stream: {err}")
     print(f"  - Exit Code: {exitcode}")
 
     return exitcode == 0
@@ -423,9 +576,9 @@ def scp_files(scp, local_files, remote_path):
 
 def yum_install_remote(ssh, path, remote_password):
     """
-    Install package on remote machine.
+    Install package(s) on remote machine.
     :param ssh: Remote connection object from remote_connect
-    :param path: Remote path to package
+    :param path: Remote path to package, or several space-separated paths to install in one transaction
     :param remote_password: Remote account password for sudo
     :return: bool Successful
     """
@@ -433,9 +586,10 @@ def yum_install_remote(ssh, path, remote_password):
     return remote_privileged_command(ssh, command, remote_password)
 
 
-def install_remote(rpms: list, remote_ip: str, remote_username: str, remote_password: str):
+def install_remote(rpms: list, remote_ip: str, remote_username: str, remote_password: str, single_tx: bool = True):
     """
     Confirms the pack list then installs the RPMs remotely.
+    :param single_tx: bool Install all RPMs in one yum transaction, otherwise one at a time
     :param remote_password: str Account Password
     :param remote_username: str Account Username (with sudo privilege)
     :param remote_ip: IP address to install at.
@@ -456,10 +610,14 @@ def install_remote(rpms: list, remote_ip: str, remote_username: str, remote_pass
     _check_fail(remote_command(ssh, f'mkdir -p {upload_dir}'))
     _check_fail(scp_files(scp, rpms, upload_dir))
 
-    remotes = [f"{upload_dir}/{x.name}" for x in rpms]
-    for remote in remotes:
-        print(f"Installing {remote}...")
-        _check_fail(yum_install_remote(ssh, remote, remote_password))
+    remotes = [shlex.quote(f"{upload_dir}/{x.name}") for x in rpms]
+    if single_tx:
+        print(f"Installing {len(remotes)} packages...")
+        _check_fail(yum_install_remote(ssh, ' '.join(remotes), remote_password))
+    else:
+        for remote in remotes:
+            print(f"Installing {remote}...")
+            _check_fail(yum_install_remote(ssh, remote, remote_password))
 
     print("Great, install complete! Your deployment is finished.")
     return True
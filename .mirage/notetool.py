@@ -4,27 +4,31 @@ import argparse
 import pathlib
 import re
 from datetime import datetime
+from functools import lru_cache
+
+NOTE_RE = re.compile(
+        r'\* (\w+ \w+ \d+ \d+) (\w+\s*\w*) <(\w+@photodiagnostic.com)>\s*-\s*(\d+.\d+.\d+.\d+)\n([^*]*)')
+
+
+@lru_cache(maxsize=None)
+def parse_date(date):
+    return datetime.strptime(date, "%a %b %d %Y")
 
 
 def main(version, output):
     working_dir = pathlib.Path('.').resolve()
-    with open(f'{output}', 'w') as out:
+    with open(f'{output}', 'w', buffering=1 << 20) as out:
         out.write(f"# v{version} Release Notes\n\n")
         for file in working_dir.rglob("release_notes.txt"):
             package = file.parent.name
             print(f"Translating {package}...")
-            out.write(f"{package}\n")
-            out.write(('-' * 16) + "\n")
             with open(file, 'r') as notes:
-                matches = re.findall(
-                        r'\* (\w+ \w+ \d+ \d+) (\w+\s*\w*) <(\w+@photodiagnostic.com)>\s*-\s*(\d+.\d+.\d+.\d+)\n([^*]*)',
-                        notes.read())
-                matches.sort(key=lambda x: datetime.strptime(x[0], "%a %b %d %Y"), reverse=True)
-                for match in matches:
-                    out.write(f"> {match[3]}\n")
-                    out.write(f"> {match[0]}\n")
-                    out.write(f"> {match[1]} <{match[2]}>\n")
-                    out.write(f"{match[4]}\n\n")
+                matches = sorted((m.groups() for m in NOTE_RE.finditer(notes.read())),
+                                 key=lambda x: parse_date(x[0]), reverse=True)
+            # Build each package's section in memory and write it once
+            out.write(f"{package}\n" + ('-' * 16) + "\n" +
+                      ''.join(f"> {match[3]}\n> {match[0]}\n> {match[1]} <{match[2]}>\n{match[4]}\n\n"
+                              for match in matches))
     print(f"Done. Check {output}.")
 
 